@@ -3,21 +3,359 @@ Kubernetes Deployment for Stock Search Agent
 Deploy to K8s cluster with auto-scaling support
 """
 import asyncio
+import functools
 import os
-import subprocess
-import sys
+import shutil
+from pathlib import Path
 
+from kubernetes import client
+from kubernetes.client.rest import ApiException
 
 from agentscope_runtime.engine.deployers.kubernetes_deployer import (
     KubernetesDeployManager,
     RegistryConfig,
     K8sConfig,
 )
-import agentscope_runtime
-print(f"🔍 Loaded agentscope_runtime from: {agentscope_runtime.__file__}")
 from stock_agent_app import app
 
 
+NAMESPACE = "agentscope-stock"
+PREPULL_NAME = "stock-agent-prepull"
+PAUSE_IMAGE = "registry.k8s.io/pause:3.9"
+BUILD_DIR = ".stock_agent_build"
+BUILDX_BUILDER = "stock-agent-builder"
+APP_SOURCES = ["stock_agent_app.py"]
+
+# Dependencies get their own stage so a source-only change (the common case,
+# since the tag is the git SHA) rebuilds and pushes just the final COPY layer.
+# The runtime stage is distroless: no shell or package manager, only the
+# interpreter, so the build stage must ship the same Python minor version.
+DOCKERFILE_TEMPLATE = """\
+# syntax=docker/dockerfile:1
+FROM {build_image} AS deps
+COPY requirements.txt .
+RUN pip install --no-cache-dir --target=/install -r requirements.txt
+# Fail the build rather than the pod if the pinned set cannot import the app;
+# -S leaves out the build image's site-packages, as in distroless
+COPY {app_sources} /src/
+RUN cd /src && PYTHONPATH=/install python -S -c "import stock_agent_app"
+
+FROM {base_image} AS app
+WORKDIR /app
+COPY --from=deps /install /app/pkgs
+COPY . /app
+ENV PYTHONPATH=/app/pkgs:/app
+EXPOSE {port}
+# Worker count comes from WEB_CONCURRENCY, which uvicorn reads natively
+ENTRYPOINT ["python3", "-m", "uvicorn", "stock_agent_app:create_asgi_app", "--factory", \\
+            "--host", "0.0.0.0", "--port", "{port}", "--loop", "uvloop", "--http", "httptools", \\
+            "--backlog", "2048", "--limit-concurrency", "512"]
+"""
+
+
+@functools.lru_cache(maxsize=1)
+def _git_sha(git_dir=".git"):
+    """Short commit SHA used as the image tag
+
+    Prefers GIT_SHA (set by CI) and otherwise reads the ref straight out of
+    the git directory, so deploys need neither a git binary nor a fork.
+    """
+    sha = os.environ.get("GIT_SHA")
+    if sha:
+        return sha[:7]
+    git_dir = Path(git_dir)
+    if git_dir.is_file():
+        # Worktrees and submodules have a `.git` file pointing at the real dir
+        pointer = git_dir.read_text().strip()
+        if not pointer.startswith("gitdir: "):
+            raise RuntimeError(f"Unrecognized {git_dir} file; set GIT_SHA explicitly")
+        git_dir = git_dir.parent / pointer[len("gitdir: "):]
+    head = (git_dir / "HEAD").read_text().strip()
+    if not head.startswith("ref: "):
+        return head[:7]  # Detached HEAD holds the SHA itself
+    ref = head[len("ref: "):]
+    # A worktree keeps its own HEAD but shares refs with the main repository
+    commondir = git_dir / "commondir"
+    if commondir.exists():
+        git_dir = git_dir / commondir.read_text().strip()
+    ref_path = git_dir / ref
+    if ref_path.exists():
+        return ref_path.read_text().strip()[:7]
+    # Ref has been packed by `git gc`
+    packed_refs = git_dir / "packed-refs"
+    if packed_refs.exists():
+        for line in packed_refs.read_text().splitlines():
+            if line.endswith(f" {ref}"):
+                return line.split()[0][:7]
+    raise RuntimeError(f"Cannot resolve {ref}; set GIT_SHA explicitly")
+
+
+def _cpu_cores(quantity):
+    """Whole cores in a K8s CPU quantity ("2000m" -> 2, "1.5" -> 1), at least 1"""
+    if quantity.endswith("m"):
+        cores = int(quantity[:-1]) / 1000
+    else:
+        cores = float(quantity)
+    return max(1, int(cores))
+
+
+class PrebuiltImage:
+    """Stands in for the deployer's image factory once the image is built"""
+
+    def __init__(self, image):
+        self.image = image
+
+    def build_runner_image(self, **kwargs):
+        return self.image
+
+    build_image = build_runner_image  # Name used by newer agentscope-runtime
+
+    def cleanup(self):
+        pass
+
+
+def _write_build_context(deployment_config):
+    """Stage Dockerfile, requirements and app sources into BUILD_DIR"""
+    os.makedirs(BUILD_DIR, exist_ok=True)
+    with open(os.path.join(BUILD_DIR, "Dockerfile"), "w") as f:
+        f.write(DOCKERFILE_TEMPLATE.format(
+            build_image=deployment_config["build_image"],
+            base_image=deployment_config["base_image"],
+            port=deployment_config["port"],
+            app_sources=" ".join(APP_SOURCES),
+        ))
+    with open(os.path.join(BUILD_DIR, "requirements.txt"), "w") as f:
+        f.write("\n".join(deployment_config["requirements"]) + "\n")
+    for source in APP_SOURCES:
+        shutil.copy(source, os.path.join(BUILD_DIR, source))
+    return BUILD_DIR
+
+
+async def _run(*cmd, check=True, quiet=False):
+    """Run a command without blocking the event loop"""
+    env = {**os.environ, "DOCKER_BUILDKIT": "1"}
+    output = asyncio.subprocess.DEVNULL if quiet else None
+    proc = await asyncio.create_subprocess_exec(*cmd, env=env, stdout=output, stderr=output)
+    returncode = await proc.wait()
+    if check and returncode != 0:
+        raise RuntimeError(f"Command failed ({returncode}): {' '.join(cmd)}")
+    return returncode
+
+
+def _output_spec(deployment_config):
+    """buildx --output value: OCI manifests, optionally eStargz layers
+
+    eStargz layers stay gzip-compatible, so plain containerd still pulls them,
+    while nodes running the stargz snapshotter lazy-pull only the files read
+    at startup. force-compression recompresses the base image layers too.
+    """
+    if not deployment_config["push_to_registry"]:
+        return "type=docker"
+    spec = "type=registry,oci-mediatypes=true"
+    if deployment_config.get("estargz"):
+        spec += ",compression=estargz,force-compression=true"
+    return spec
+
+
+async def build_image(deployment_config, registry):
+    """Build the agent image with BuildKit and push it to `registry`
+
+    Layers are cached in the registry refs given by
+    deployment_config["build_cache"] so any builder (laptop or CI runner)
+    reuses the dependency layer.
+    Pushing straight from BuildKit only uploads blobs the registry does not
+    already have. When CI supplies GIT_SHA the tag identifies a clean
+    checkout, so a tag that is already present (redeploying the same commit)
+    is not rebuilt; local builds from a possibly dirty tree always rebuild.
+    Returns the image reference without the registry prefix, as the
+    deployer adds it back when creating the Deployment.
+    """
+    name = deployment_config["image_name"]
+    image = f"{name}:{deployment_config['image_tag']}"
+    build_cache = deployment_config.get("build_cache") or {}
+    push = deployment_config["push_to_registry"]
+
+    if push and os.getenv("GIT_SHA"):
+        inspect = ("docker", "buildx", "imagetools", "inspect", f"{registry}/{image}")
+        if await _run(*inspect, check=False, quiet=True) == 0:
+            print(f"   ♻️  {image} already in registry, skipping build and push")
+            return image
+
+    context = _write_build_context(deployment_config)
+
+    # The default "docker" driver cannot export cache to a registry
+    if await _run("docker", "buildx", "inspect", BUILDX_BUILDER, check=False, quiet=True) != 0:
+        await _run("docker", "buildx", "create", "--name", BUILDX_BUILDER, "--driver", "docker-container")
+
+    cache_args = []
+    if build_cache.get("from"):
+        cache_args += ["--cache-from", f"type=registry,ref={build_cache['from']}"]
+    if build_cache.get("to"):
+        cache_args += ["--cache-to", f"type=registry,ref={build_cache['to']},mode=max"]
+
+    await _run(
+        "docker", "buildx", "build",
+        "--builder", BUILDX_BUILDER,
+        "--platform", deployment_config["platform"],
+        "-t", f"{registry}/{image}",
+        *cache_args,
+        "--output", _output_spec(deployment_config),
+        context,
+    )
+    return image
+
+
+def _prepull_daemonset(image, platform, image_pull_secrets=()):
+    """Build a DaemonSet that pulls `image` onto every node and then idles
+
+    Only nodes matching the image `platform` (e.g. "linux/amd64") are
+    targeted; on others the pod could never start and the rollout would
+    wait for it until the timeout.
+    """
+    os_, arch = platform.split("/")[:2]
+    labels = {"app": PREPULL_NAME}
+    return {
+        "apiVersion": "apps/v1",
+        "kind": "DaemonSet",
+        "metadata": {"name": PREPULL_NAME, "labels": labels},
+        "spec": {
+            "selector": {"matchLabels": labels},
+            "template": {
+                "metadata": {"labels": labels},
+                "spec": {
+                    # The init container only exists to force the pull;
+                    # the pause container keeps the pod Ready afterwards
+                    "initContainers": [{
+                        "name": "prepull",
+                        "image": image,
+                        "imagePullPolicy": "IfNotPresent",
+                        "command": ["python3", "-c", "pass"],  # No /bin/true in distroless
+                    }],
+                    "containers": [{
+                        "name": "pause",
+                        "image": PAUSE_IMAGE,
+                        "resources": {
+                            "requests": {"cpu": "1m", "memory": "8Mi"},
+                            "limits": {"cpu": "10m", "memory": "16Mi"},
+                        },
+                    }],
+                    "nodeSelector": {"kubernetes.io/os": os_, "kubernetes.io/arch": arch},
+                    "tolerations": [{"operator": "Exists"}],  # Every node, including tainted ones
+                    "imagePullSecrets": [{"name": s} for s in image_pull_secrets],
+                    "restartPolicy": "Always",
+                },
+            },
+        },
+    }
+
+
+async def prepull_image(k8s_client, image, platform, namespace=NAMESPACE, image_pull_secrets=(), timeout=300):
+    """Warm every node's image cache before the Deployment rolls out
+
+    Without this, each replica pulls the same image from the registry at the
+    same time on a cold rollout. The DaemonSet is removed once all nodes are
+    ready; the pulled layers stay in the node cache. `k8s_client` is the
+    deployer's KubernetesClient, so the same cluster is targeted.
+    """
+    print(f"📥 Pre-pulling {image} onto cluster nodes...")
+    core = k8s_client.v1
+    apps = k8s_client.apps_v1
+
+    try:
+        core.create_namespace({"metadata": {"name": namespace}})
+    except ApiException as e:
+        if e.status != 409:  # Already exists
+            raise
+
+    body = _prepull_daemonset(image, platform, image_pull_secrets)
+    try:
+        apps.create_namespaced_daemon_set(namespace, body)
+    except ApiException as e:
+        if e.status != 409:
+            raise
+        apps.replace_namespaced_daemon_set(PREPULL_NAME, namespace, body)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    try:
+        while True:
+            status = apps.read_namespaced_daemon_set_status(PREPULL_NAME, namespace).status
+            desired = status.desired_number_scheduled or 0
+            if desired and (status.number_ready or 0) == desired and (status.updated_number_scheduled or 0) == desired:
+                print(f"   ✅ Image cached on {desired} node(s)")
+                return
+            if loop.time() > deadline:
+                print(f"   ⚠️  Pre-pull timed out ({status.number_ready or 0}/{desired} nodes ready), continuing")
+                return
+            await asyncio.sleep(2)
+    finally:
+        apps.delete_namespaced_daemon_set(PREPULL_NAME, namespace)
+
+
+PROBE_KEYS = ("startupProbe", "readinessProbe", "livenessProbe")
+
+
+def add_probes(k8s_client, runtime_config):
+    """Make `k8s_client` build Deployments with the probes from `runtime_config`
+
+    KubernetesClient ignores probe keys in runtime_config. Patching them on
+    after creation would start a second rollout whose first pods take traffic
+    unprobed, so the spec builder is wrapped to set them before creation.
+    """
+    probes = {key: runtime_config[key] for key in PROBE_KEYS if key in runtime_config}
+    create_spec = k8s_client._create_deployment_spec
+
+    @functools.wraps(create_spec)
+    def _create_deployment_spec(*args, **kwargs):
+        spec = create_spec(*args, **kwargs)
+        container = spec.template.spec.containers[0]
+        container.startup_probe = probes.get("startupProbe")
+        container.readiness_probe = probes.get("readinessProbe")
+        container.liveness_probe = probes.get("livenessProbe")
+        return spec
+
+    k8s_client._create_deployment_spec = _create_deployment_spec
+
+
+def apply_hpa(k8s_client, deployment_name, namespace=NAMESPACE, min_replicas=2, max_replicas=20, cpu_utilization=60):
+    """Create or update a CPU-based HorizontalPodAutoscaler for the Deployment
+
+    Custom metrics (e.g. /chat request rate scraped from /metrics) can be
+    appended to `metrics` once a Prometheus adapter is installed.
+    `k8s_client` is the deployer's KubernetesClient, as for prepull_image.
+    """
+    body = {
+        "apiVersion": "autoscaling/v2",
+        "kind": "HorizontalPodAutoscaler",
+        "metadata": {"name": deployment_name},
+        "spec": {
+            "scaleTargetRef": {
+                "apiVersion": "apps/v1",
+                "kind": "Deployment",
+                "name": deployment_name,
+            },
+            "minReplicas": min_replicas,
+            "maxReplicas": max_replicas,
+            "metrics": [{
+                "type": "Resource",
+                "resource": {
+                    "name": "cpu",
+                    "target": {"type": "Utilization", "averageUtilization": cpu_utilization},
+                },
+            }],
+        },
+    }
+    # Same ApiClient, hence the same cluster and credentials, as the deployer
+    autoscaling = client.AutoscalingV2Api(k8s_client.apps_v1.api_client)
+    try:
+        autoscaling.create_namespaced_horizontal_pod_autoscaler(namespace, body)
+    except ApiException as e:
+        if e.status != 409:
+            raise
+        autoscaling.replace_namespaced_horizontal_pod_autoscaler(deployment_name, namespace, body)
+    print(f"📈 Autoscaling {deployment_name}: {min_replicas}-{max_replicas} replicas at {cpu_utilization}% CPU")
+
+
 async def deploy_stock_agent_to_k8s():
     """Deploy Stock Search Agent to Kubernetes"""
     
@@ -26,7 +364,7 @@ async def deploy_stock_agent_to_k8s():
     # Configure Kubernetes deployer
     deployer = KubernetesDeployManager(
         kube_config=K8sConfig(
-            k8s_namespace="agentscope-stock",  # Dedicated namespace for stock agent
+            k8s_namespace=NAMESPACE,  # Dedicated namespace for stock agent
             kubeconfig_path=None,  # Uses default ~/.kube/config
         ),
         registry_config=RegistryConfig(
@@ -36,24 +374,45 @@ async def deploy_stock_agent_to_k8s():
         use_deployment=True,  # Use K8s Deployment instead of Job
     )
     
+    registry = deployer.registry_config.get_full_url()
+    # Point BUILD_CACHE_REF at a dedicated cache repo, or set it empty to build without a cache
+    cache_ref = os.getenv("BUILD_CACHE_REF", f"{registry}/stock-agent:buildcache")
+
     # Define deployment configuration
     deployment_config = {
         "port": "8080",
         "replicas": 2,  # Start with 2 replicas for HA
         "image_name": "stock-agent",
-        "image_tag": subprocess.check_output(["git", "rev-parse", "--short", "HEAD"]).decode("utf-8").strip(),
+        "image_tag": _git_sha(),
+        # The container entrypoint (stock_agent_app.create_asgi_app) uses
+        # agentscope-runtime 0.2.0 internals; 1.x drops them. The pins below
+        # it cover imports its metadata leaves out or unbounded, and the
+        # deps stage checks the set by importing the app.
         "requirements": [
-            "agentscope",
-            "agentscope-runtime",
+            "agentscope==1.0.21",
+            "agentscope-runtime==0.2.0",
+            "a2a-sdk>=0.3.0,<0.4",  # 0.4 drops a2a.server.apps
+            "mcp>=1.13,<2",  # 2.x drops streamablehttp_client
+            "sqlalchemy[asyncio]",  # greenlet for sqlalchemy.ext.asyncio
+            "jinja2",
+            "psutil",
+            "tqdm",
             "fastapi",
             "uvicorn",
-            "requests",
+            "uvloop",
+            "httptools",
+            "orjson",
+            "prometheus-fastapi-instrumentator",
         ],
-        "base_image": "python:3.10-slim-bookworm",
+        "build_image": "python:3.11-slim-bookworm",  # Must match the distroless Python
+        "base_image": "gcr.io/distroless/python3-debian12:nonroot",
         "environment": {
-            "PYTHONPATH": "/app",
+            "PYTHONPATH": "/app/pkgs:/app",
             "DASHSCOPE_API_KEY": os.environ.get("DASHSCOPE_API_KEY"),
             "LOG_LEVEL": "INFO",
+            # Shared metric store so /metrics aggregates every uvicorn worker
+            # (/tmp is the only writable path on distroless nonroot)
+            "PROMETHEUS_MULTIPROC_DIR": "/tmp/prom",
         },
         "runtime_config": {
             "resources": {
@@ -66,29 +425,48 @@ async def deploy_stock_agent_to_k8s():
                     "memory": "4Gi"  # 4GB RAM max
                 },
             },
-            # Health checks
+            # Health checks (set on the Deployment spec by add_probes)
+            "startupProbe": {
+                "httpGet": {
+                    "path": "/ready",  # Holds off liveness until the agent warm-up is done
+                    "port": 8080
+                },
+                "periodSeconds": 5,
+                "failureThreshold": 30  # Up to 150s for the first model round-trip
+            },
             "readinessProbe": {
                 "httpGet": {
-                    "path": "/health",
+                    "path": "/ready",  # Gated on agent warm-up
                     "port": 8080
                 },
-                "initialDelaySeconds": 10,
+                "initialDelaySeconds": 15,
                 "periodSeconds": 5
             },
             "livenessProbe": {
                 "httpGet": {
-                    "path": "/health",
+                    "path": "/health",  # Cheap in-process check, never calls the LLM
                     "port": 8080
                 },
                 "initialDelaySeconds": 30,
                 "periodSeconds": 10
             },
             "image_pull_secrets": ["regcred"],  # Secrets for pulling images from private registry
+            "image_pull_policy": "IfNotPresent",  # Warm nodes skip the registry round-trip
         },
         "platform": "linux/amd64",
         "push_to_registry": True,  # Push image to registry
+        "estargz": True,  # Lazy-pullable layers for nodes with the stargz snapshotter
+        # Registry-backed BuildKit cache shared by every builder (CI runners, laptops)
+        "build_cache": {"from": cache_ref, "to": cache_ref} if cache_ref else None,
     }
     
+    # One uvicorn worker per core of the CPU limit so every core serves requests.
+    # The deployer only supports literal env values, so this is resolved here
+    # rather than through the downward API.
+    deployment_config["environment"]["WEB_CONCURRENCY"] = str(
+        _cpu_cores(deployment_config["runtime_config"]["resources"]["limits"]["cpu"])
+    )
+
     print("📦 Building and pushing container image...")
     print(f"   Image: {deployment_config['image_name']}:{deployment_config['image_tag']}")
     print(f"   Replicas: {deployment_config['replicas']}")
@@ -96,7 +474,20 @@ async def deploy_stock_agent_to_k8s():
     
     # Deploy to Kubernetes
     try:
+        image = await build_image(deployment_config, registry)
+        deployer.image_factory = PrebuiltImage(image)
+        add_probes(deployer.k8s_client, deployment_config["runtime_config"])
+
+        # Image lands on every node before the replicas schedule
+        await prepull_image(
+            deployer.k8s_client,
+            f"{registry}/{image}",
+            deployment_config["platform"],
+            image_pull_secrets=deployment_config["runtime_config"]["image_pull_secrets"],
+        )
+
         result = await app.deploy(deployer, **deployment_config)
+        apply_hpa(deployer.k8s_client, result["resource_name"], min_replicas=deployment_config["replicas"])
         
         print("\n✅ Deployment successful!")
         print(f"📍 Service URL: {result['url']}")
@@ -113,7 +504,7 @@ async def deploy_stock_agent_to_k8s():
         print("   kubectl get pods -n agentscope-stock")
         print("   kubectl get svc -n agentscope-stock")
         print("   kubectl logs -n agentscope-stock -l app=stock-agent")
-        print("   kubectl scale deployment stock-agent --replicas=5 -n agentscope-stock")
+        print("   kubectl get hpa -n agentscope-stock")
         
         return result
         
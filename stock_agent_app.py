@@ -2,18 +2,110 @@
 AgentScope Stock Search Agent Demo
 Searches for current stock information (e.g., NVIDIA)
 """
+import asyncio
+import functools
+import hashlib
+import inspect
 import os
 import json
-import requests
+import re
+import types
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from fastapi import Request
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
+from prometheus_fastapi_instrumentator import Instrumentator
 from agentscope.agent import ReActAgent
 from agentscope.model import DashScopeChatModel
 from agentscope.tool import Toolkit
+from dashscope.common.error import DashScopeException
 from agentscope_runtime.engine.agents.agentscope_agent import AgentScopeAgent
 from agentscope_runtime.engine.app import AgentApp
-from agentscope_runtime.engine.schemas.agent_schemas import AgentRequest
+from agentscope_runtime.engine.deployers.utils.deployment_modes import DeploymentMode
+from agentscope_runtime.engine.deployers.utils.service_utils.fastapi_factory import FastAPIAppFactory
+from agentscope_runtime.engine.deployers.utils.service_utils.service_config import DEFAULT_SERVICES_CONFIG
+from agentscope_runtime.engine.schemas.agent_schemas import AgentRequest, MessageType
+
+
+# prometheus_client's multiprocess mode needs its directory before the first
+# metric is created; each uvicorn worker writes its own files there
+if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+
+@dataclass(frozen=True, slots=True)
+class StockQuote:
+    """Static quote record for one ticker"""
+    symbol: str
+    company: str
+    price: float
+    change: str
+    market_cap: str
+    pe_ratio: float | None = None
+    high52: float | None = None
+    low52: float | None = None
+    description: str | None = None
+
+    def to_dict(self) -> dict:
+        """Tool payload, using the field names the agent prompt expects"""
+        data = {
+            "symbol": self.symbol,
+            "company": self.company,
+            "price": self.price,
+            "change": self.change,
+            "market_cap": self.market_cap,
+            "pe_ratio": self.pe_ratio,
+            "52_week_high": self.high52,
+            "52_week_low": self.low52,
+            "description": self.description,
+        }
+        return {k: v for k, v in data.items() if v is not None}
+
+
+# Stock data for the search tool
+# Use Yahoo Finance API alternative or financial data API
+# For demo purposes, simulating with current NVIDIA data
+_QUOTES = (
+    StockQuote(
+        symbol="NVDA",
+        company="NVIDIA Corporation",
+        price=180.05,
+        change="+1.06%",
+        market_cap="4.4T",
+        pe_ratio=44.31,
+        high52=212.19,
+        low52=86.62,
+        description="AI infrastructure and GPU computing company",
+    ),
+    StockQuote(
+        symbol="AAPL",
+        company="Apple Inc.",
+        price=189.50,
+        change="+0.5%",
+        market_cap="3.0T",
+    ),
+    StockQuote(
+        symbol="MSFT",
+        company="Microsoft Corporation",
+        price=378.20,
+        change="+0.8%",
+        market_cap="2.8T",
+    ),
+)
+_BY_SYMBOL: dict[str, StockQuote] = {quote.symbol: quote for quote in _QUOTES}
+
+# Success payloads are built once at import and shared by reference;
+# callers must treat them as read-only
+_RESPONSES = types.MappingProxyType({
+    symbol: {"status": "success", "data": quote.to_dict()}
+    for symbol, quote in _BY_SYMBOL.items()
+})
+_NOT_FOUND_TEMPLATE = "Stock symbol '{symbol}' not found. Try NVDA, AAPL, or MSFT."
 
 
 # Define stock search tool
+@functools.lru_cache(maxsize=64)
 def search_stock_price(symbol: str) -> dict:
     """
     Search for current stock price information
@@ -24,123 +116,276 @@ def search_stock_price(symbol: str) -> dict:
     Returns:
         Dictionary with stock information
     """
-    # Use Yahoo Finance API alternative or financial data API
-    # For demo purposes, simulating with current NVIDIA data
-    
-    stock_data = {
-        "NVDA": {
-            "symbol": "NVDA",
-            "company": "NVIDIA Corporation",
-            "price": 180.05,
-            "change": "+1.06%",
-            "market_cap": "4.4T",
-            "pe_ratio": 44.31,
-            "52_week_high": 212.19,
-            "52_week_low": 86.62,
-            "description": "AI infrastructure and GPU computing company"
-        },
-        "AAPL": {
-            "symbol": "AAPL",
-            "company": "Apple Inc.",
-            "price": 189.50,
-            "change": "+0.5%",
-            "market_cap": "3.0T"
-        },
-        "MSFT": {
-            "symbol": "MSFT",
-            "company": "Microsoft Corporation",
-            "price": 378.20,
-            "change": "+0.8%",
-            "market_cap": "2.8T"
-        }
+    return _RESPONSES.get(symbol.upper()) or {
+        "status": "not_found",
+        "message": _NOT_FOUND_TEMPLATE.format(symbol=symbol),
     }
-    
-    symbol_upper = symbol.upper()
-    if symbol_upper in stock_data:
-        return {
-            "status": "success",
-            "data": stock_data[symbol_upper]
-        }
-    else:
-        return {
-            "status": "not_found",
-            "message": f"Stock symbol '{symbol}' not found. Try NVDA, AAPL, or MSFT."
-        }
 
 
 # Create toolkit and register tool
 toolkit = Toolkit()
 toolkit.register_tool_function(search_stock_price)
 
+
 # Create agent with stock search capability
-agent = AgentScopeAgent(
-    name="StockAssistant",
-    model=DashScopeChatModel(
+@functools.lru_cache(maxsize=1)
+def _get_model():
+    """Process-wide DashScope model client, shared by the agent and warm-up"""
+    return DashScopeChatModel(
         "qwen-max",
         api_key=os.getenv("DASHSCOPE_API_KEY"),
-    ),
-    agent_config={
-        "sys_prompt": (
-            "You're a helpful financial assistant that can search stock prices. "
-            "When users ask about stocks, use the search_stock_price tool to get current data. "
-            "Provide clear, concise information about stock prices and market data."
-        ),
-        "toolkit": toolkit,
-    },
-    agent_builder=ReActAgent,
-)
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def _get_agent():
+    """Process-wide agent; the model client is built once"""
+    return AgentScopeAgent(
+        name="StockAssistant",
+        model=_get_model(),
+        agent_config={
+            "sys_prompt": (
+                "You're a helpful financial assistant that can search stock prices. "
+                "When users ask about stocks, use the search_stock_price tool to get current data. "
+                "Provide clear, concise information about stock prices and market data."
+            ),
+            "toolkit": toolkit,
+        },
+        agent_builder=ReActAgent,
+    )
+
+
+agent = _get_agent()
+
+
+# Flipped once the agent has been warmed up; gates the readiness probe
+_agent_ready = False
+_warm_up_task = None
+
+
+async def _warm_up_agent():
+    """Pay the model handshake before the first real /chat request"""
+    global _agent_ready
+    try:
+        response = await _get_model()(
+            [{"role": "user", "content": "ping"}],
+            max_tokens=1,
+        )
+        if inspect.isasyncgen(response):  # Streaming models yield chunks
+            async for _ in response:
+                pass
+    except (DashScopeException, RuntimeError, OSError, asyncio.TimeoutError) as e:
+        # Model/network failures are best effort and expected while the
+        # model endpoint is flaky; anything else is a bug and propagates
+        print(f"⚠️  Agent warm-up failed: {e}")
+    finally:
+        # Warm-up only saves latency, so even a crash must not keep the pod
+        # unready and have the startupProbe restart it in a loop
+        _agent_ready = True
+
+
+def _report_warm_up(task):
+    """Log a warm-up crash; nothing else awaits the task"""
+    if not task.cancelled() and task.exception() is not None:
+        print(f"❌ Agent warm-up crashed: {task.exception()!r}")
+
+
+async def start_warm_up(app, **kwargs):
+    """Warm the agent in the background so /health answers meanwhile"""
+    global _warm_up_task
+    _warm_up_task = asyncio.create_task(_warm_up_agent())
+    _warm_up_task.add_done_callback(_report_warm_up)
+
 
 # Create AgentApp with multiple endpoints
-app = AgentApp(agent=agent)
+app = AgentApp(agent=agent, before_start=start_warm_up)
+
+
+# Liveness is served by the runtime's built-in /health, which never touches
+# the agent; readiness additionally waits for the agent warm-up
+@app.endpoint("/ready", methods=["GET"])
+def ready_handler():
+    """Readiness probe; 503 until the agent can take traffic"""
+    if _agent_ready:
+        return {"status": "ok"}
+    return JSONResponse({"status": "starting"}, status_code=503)
 
 
 @app.endpoint("/stock_query")
 def stock_query_handler(request: AgentRequest):
     """Handle stock price queries"""
-    return {
+    return ORJSONResponse({
         "status": "ok",
-        "payload": request,
+        "payload": request.model_dump(),
         "message": "Use /chat for interactive queries"
-    }
+    })
+
+
+# Bounded LRU of agent replies keyed on a digest of the normalized prompt.
+# Values are the tasks computing the replies, so concurrent duplicates of an
+# in-flight prompt await the same agent call instead of each making one.
+# Only touched from the event loop thread, so no locking is needed.
+REPLY_CACHE_SIZE = 512
+_reply_cache = OrderedDict()
+
+
+def _prompt_key(prompt: str) -> bytes:
+    """Digest of the prompt with case and whitespace normalized"""
+    normalized = " ".join(prompt.split()).casefold()
+    return hashlib.blake2b(normalized.encode(), digest_size=16).digest()
+
+
+def _evict_failed_reply(key: bytes, task: asyncio.Task):
+    """Drop a failed or cancelled reply so the next request retries it"""
+    if task.cancelled() or task.exception() is not None:
+        if _reply_cache.get(key) is task:
+            del _reply_cache[key]
+
+
+async def _agent_reply(request: AgentRequest) -> str:
+    """Run `request` through the runner and return the agent's final text
+
+    The agent is fully async (model and tool calls are awaited), so it runs
+    on the event loop without blocking concurrent requests.
+    """
+    response = None
+    async for event in app._runner.stream_query(request):
+        response = event  # The last event is the completed AgentResponse
+    for message in reversed(response.output or []):
+        if message.type == MessageType.MESSAGE:
+            return message.get_text_content() or ""
+    return ""
 
 
 @app.endpoint("/chat")
-async def chat_handler(request: AgentRequest):
-    """Handle chat-based stock queries"""
+async def chat_handler(http_request: Request):
+    """Handle chat-based stock queries
+
+    Identical prompts are answered from the reply cache; send an
+    `X-No-Cache` header to force a fresh agent call.
+    """
+    try:
+        request = AgentRequest(**await http_request.json())
+    except (ValueError, TypeError) as e:
+        # Malformed JSON, a non-object body or a schema mismatch; same
+        # response the runtime's parameter wrapper gives other endpoints
+        return JSONResponse(
+            status_code=422,
+            content={"detail": f"Request parsing error: {str(e)}"},
+        )
     # Process the user's query through the agent
-    user_input = request.input[0]["content"][0]["text"] if request.input else "Hello"
+    user_input = request.input[0].content[0].text if request.input else "Hello"
     
-    # Agent processes the query
-    response = agent.reply({"content": user_input})
+    key = _prompt_key(user_input)
+    reply = None if "x-no-cache" in http_request.headers else _reply_cache.get(key)
+    if reply is None:
+        reply = asyncio.create_task(_agent_reply(request))
+        reply.add_done_callback(functools.partial(_evict_failed_reply, key))
+        _reply_cache[key] = reply
+        if len(_reply_cache) > REPLY_CACHE_SIZE:
+            _reply_cache.popitem(last=False)
+    else:
+        _reply_cache.move_to_end(key)
+    # Shielded so a client disconnecting does not cancel the agent call for
+    # the other requests awaiting the same reply
+    content = await asyncio.shield(reply)
     
-    return {
+    return ORJSONResponse({
         "status": "success",
-        "response": response.content if hasattr(response, 'content') else str(response),
+        "response": content,
         "session_id": request.session_id
-    }
+    })
+
+
+# Tickers or company names mentioned in a free-text query, matched in a
+# single case-insensitive pass without lowering a copy of the input
+_TICKER_ALIASES = {
+    "nvda": "NVDA",
+    "nvidia": "NVDA",
+    "aapl": "AAPL",
+    "apple": "AAPL",
+    "msft": "MSFT",
+    "microsoft": "MSFT",
+}
+# ASCII-only case folding: under Unicode rules "ſ" or "ı" would match but not
+# lower() back to an alias key
+_TICKER_RE = re.compile(r"\b(" + "|".join(_TICKER_ALIASES) + r")\b", re.IGNORECASE | re.ASCII)
+
+
+def _find_quote(text: str) -> StockQuote | None:
+    """First stock mentioned in `text` by ticker or company name, if any"""
+    match = _TICKER_RE.search(text)
+    if match is None:
+        return None
+    symbol = _TICKER_ALIASES.get(match.group(1).lower())
+    return _BY_SYMBOL.get(symbol) if symbol else None
+
+
+def _sse(text: str) -> str:
+    """Frame `text` as one server-sent event (one data field per line)"""
+    return "".join(f"data: {line}\n" for line in text.splitlines()) + "\n"
 
 
 @app.endpoint("/stream_chat")
 async def stream_chat_handler(request: AgentRequest):
-    """Stream responses for stock queries"""
-    user_input = request.input[0]["content"][0]["text"] if request.input else ""
+    """Stream responses for stock queries as server-sent events"""
+    user_input = request.input[0].content[0].text if request.input else ""
     
-    # Simulate streaming response
-    yield f"Processing query: {user_input}\n"
+    async def _gen():
+        # Simulate streaming response
+        yield _sse(f"Processing query: {user_input}")
+        await asyncio.sleep(0)  # Let the first frame flush before the lookup
+        
+        # Get stock info
+        quote = _find_quote(user_input)
+        if quote is not None:
+            summary = (
+                f"Stock: {quote.company} ({quote.symbol})\n"
+                f"Current Price: ${quote.price}\n"
+                f"Change: {quote.change}\n"
+                f"Market Cap: {quote.market_cap}"
+            )
+            if quote.pe_ratio is not None:
+                summary += f"\nP/E Ratio: {quote.pe_ratio}"
+            yield _sse(summary)
+        else:
+            yield _sse("Please specify a stock symbol (e.g., NVDA, AAPL, MSFT)")
     
-    # Get stock info
-    if "nvda" in user_input.lower() or "nvidia" in user_input.lower():
-        result = search_stock_price("NVDA")
-        if result["status"] == "success":
-            data = result["data"]
-            yield f"Stock: {data['company']} ({data['symbol']})\n"
-            yield f"Current Price: ${data['price']}\n"
-            yield f"Change: {data['change']}\n"
-            yield f"Market Cap: {data['market_cap']}\n"
-            yield f"P/E Ratio: {data['pe_ratio']}\n"
-    else:
-        yield "Please specify a stock symbol (e.g., NVDA, AAPL, MSFT)\n"
+    return StreamingResponse(
+        _gen(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+def create_asgi_app():
+    """Build the ASGI app for `uvicorn --factory` (same wiring as app.run)
+
+    Per-handler request counts and latencies are exposed on /metrics for
+    Prometheus and custom-metric autoscaling.
+    """
+    fastapi_app = FastAPIAppFactory.create_app(
+        runner=app._runner,
+        endpoint_path=app.endpoint_path,
+        request_model=app.request_model,
+        response_type=app.response_type,
+        stream=app.stream,
+        before_start=app.before_start,
+        after_finish=app.after_finish,
+        mode=DeploymentMode.DAEMON_THREAD,
+        services_config=DEFAULT_SERVICES_CONFIG,
+        protocol_adapters=app.protocol_adapters,
+        custom_endpoints=app.custom_endpoints,
+        broker_url=app.broker_url,
+        backend_url=app.backend_url,
+    )
+    Instrumentator().instrument(fastapi_app).expose(fastapi_app)
+    return fastapi_app
 
 
 print("✅ Stock Search Agent configured successfully")
-print("📊 Available endpoints: /stock_query, /chat, /stream_chat")
+print("📊 Available endpoints: /stock_query, /chat, /stream_chat, /ready, /metrics")
+
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=int(os.getenv("PORT", "8080")))
@@ -3,6 +3,8 @@
 Test script for Stock Search Agent
 Run this locally before K8s deployment
 """
+import asyncio
+import httpx
 import requests
 import json
 import time
@@ -109,11 +111,22 @@ def test_kubernetes_deployment(service_url):
     
     # Additional K8s specific tests
     print("\n5️⃣ Load Test (Multiple Requests)")
-    import concurrent.futures
+    try:
+        import uvloop
+        results = uvloop.run(_load_test(service_url, 20))
+    except ImportError:
+        results = asyncio.run(_load_test(service_url, 20))  # Standard loop works, just slower
     
-    def make_request(i):
+    success_rate = sum(results) / len(results) * 100
+    print(f"   📊 Success rate: {success_rate:.1f}% ({sum(results)}/{len(results)})")
+
+
+async def _load_test(service_url, n_requests):
+    """Fire all requests concurrently over one connection pool"""
+    
+    async def make_request(client, i):
         try:
-            response = requests.post(
+            response = await client.post(
                 f"{service_url}/chat",
                 json={
                     "input": [{
@@ -125,14 +138,11 @@ def test_kubernetes_deployment(service_url):
                 timeout=5
             )
             return response.status_code == 200
-        except:
+        except httpx.HTTPError:
             return False
     
-    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-        results = list(executor.map(make_request, range(20)))
-    
-    success_rate = sum(results) / len(results) * 100
-    print(f"   📊 Success rate: {success_rate:.1f}% ({sum(results)}/{len(results)})")
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=200)) as client:
+        return await asyncio.gather(*(make_request(client, i) for i in range(n_requests)))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,105 @@
+"""
+Unit tests for the pure helpers of the Kubernetes deploy script
+Run with: pytest test_k8s_deploy_stock.py
+"""
+import pytest
+
+pytest.importorskip("kubernetes")
+pytest.importorskip("agentscope_runtime")
+
+from k8s_deploy_stock import _cpu_cores, _git_sha, _output_spec
+
+SHA = "0123456789abcdef0123456789abcdef01234567"
+OTHER_SHA = "fedcba9876543210fedcba9876543210fedcba98"
+
+
+@pytest.fixture
+def git_sha(monkeypatch):
+    """Uncached _git_sha with GIT_SHA unset"""
+    monkeypatch.delenv("GIT_SHA", raising=False)
+    return _git_sha.__wrapped__
+
+
+def _write(path, text):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+
+
+def test_git_sha_prefers_env(git_sha, monkeypatch, tmp_path):
+    monkeypatch.setenv("GIT_SHA", SHA)
+    assert git_sha(tmp_path / ".git") == "0123456"
+
+
+def test_git_sha_detached_head(git_sha, tmp_path):
+    _write(tmp_path / ".git" / "HEAD", f"{SHA}\n")
+    assert git_sha(tmp_path / ".git") == "0123456"
+
+
+def test_git_sha_loose_ref(git_sha, tmp_path):
+    _write(tmp_path / ".git" / "HEAD", "ref: refs/heads/main\n")
+    _write(tmp_path / ".git" / "refs" / "heads" / "main", f"{SHA}\n")
+    assert git_sha(tmp_path / ".git") == "0123456"
+
+
+def test_git_sha_packed_ref(git_sha, tmp_path):
+    _write(tmp_path / ".git" / "HEAD", "ref: refs/heads/main\n")
+    _write(tmp_path / ".git" / "packed-refs", (
+        "# pack-refs with: peeled fully-peeled sorted\n"
+        f"{OTHER_SHA} refs/heads/feature\n"
+        f"{SHA} refs/heads/main\n"
+        f"^{OTHER_SHA}\n"
+    ))
+    assert git_sha(tmp_path / ".git") == "0123456"
+
+
+def test_git_sha_unresolvable_ref(git_sha, tmp_path):
+    _write(tmp_path / ".git" / "HEAD", "ref: refs/heads/main\n")
+    with pytest.raises(RuntimeError, match="set GIT_SHA explicitly"):
+        git_sha(tmp_path / ".git")
+
+
+def test_git_sha_follows_gitdir_file(git_sha, tmp_path):
+    # Submodule layout: .git file with a path relative to the checkout
+    _write(tmp_path / "repo" / ".git" / "modules" / "sub" / "HEAD", f"{SHA}\n")
+    _write(tmp_path / "repo" / "sub" / ".git", "gitdir: ../.git/modules/sub\n")
+    assert git_sha(tmp_path / "repo" / "sub" / ".git") == "0123456"
+
+
+def test_git_sha_worktree_reads_refs_from_commondir(git_sha, tmp_path):
+    main = tmp_path / "main" / ".git"
+    _write(main / "refs" / "heads" / "feature", f"{SHA}\n")
+    _write(main / "worktrees" / "wt" / "HEAD", "ref: refs/heads/feature\n")
+    _write(main / "worktrees" / "wt" / "commondir", "../..\n")
+    _write(tmp_path / "wt" / ".git", f"gitdir: {main / 'worktrees' / 'wt'}\n")
+    assert git_sha(tmp_path / "wt" / ".git") == "0123456"
+
+
+def test_git_sha_rejects_unknown_git_file(git_sha, tmp_path):
+    _write(tmp_path / ".git", "not a pointer\n")
+    with pytest.raises(RuntimeError, match="set GIT_SHA explicitly"):
+        git_sha(tmp_path / ".git")
+
+
+@pytest.mark.parametrize("quantity, cores", [
+    ("2000m", 2),
+    ("2500m", 2),
+    ("500m", 1),
+    ("4", 4),
+    ("1.5", 1),
+    ("0.25", 1),
+])
+def test_cpu_cores(quantity, cores):
+    assert _cpu_cores(quantity) == cores
+
+
+@pytest.mark.parametrize("config, spec", [
+    ({"push_to_registry": False, "estargz": True}, "type=docker"),
+    ({"push_to_registry": True}, "type=registry,oci-mediatypes=true"),
+    ({"push_to_registry": True, "estargz": False}, "type=registry,oci-mediatypes=true"),
+    (
+        {"push_to_registry": True, "estargz": True},
+        "type=registry,oci-mediatypes=true,compression=estargz,force-compression=true",
+    ),
+])
+def test_output_spec(config, spec):
+    assert _output_spec(config) == spec
@@ -0,0 +1,145 @@
+"""
+Unit tests for the Stock Search Agent request helpers
+Run with: pytest test_stock_agent_app.py
+"""
+import asyncio
+import time
+import types
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("agentscope_runtime")
+
+from agentscope.model import ChatResponse, DashScopeChatModel
+from fastapi.testclient import TestClient
+
+import stock_agent_app
+from stock_agent_app import _find_quote, _sse
+
+
+def _body(text):
+    """AgentRequest payload with a single user text message"""
+    return {
+        "input": [{"role": "user", "content": [{"type": "text", "text": text}]}],
+        "session_id": "test",
+    }
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """App client with the model warm-up skipped and an empty reply cache"""
+    async def _ready():
+        monkeypatch.setattr(stock_agent_app, "_agent_ready", True)
+
+    monkeypatch.setattr(stock_agent_app, "_warm_up_agent", _ready)
+    monkeypatch.setattr(stock_agent_app, "_reply_cache", OrderedDict())
+    with TestClient(stock_agent_app.create_asgi_app()) as c:
+        yield c
+
+
+@pytest.fixture
+def model(monkeypatch):
+    """Stub out the DashScope model; records each call and can be made to fail"""
+    stub = types.SimpleNamespace(calls=0, fail=False)
+
+    async def _fake_call(self, messages, **kwargs):
+        stub.calls += 1
+        await asyncio.sleep(0.1)  # Keeps concurrent duplicates in flight together
+        if stub.fail:
+            raise RuntimeError("model unavailable")
+
+        async def _stream():
+            yield ChatResponse(content=[{"type": "text", "text": "NVDA is at $180.05"}])
+        return _stream()
+
+    monkeypatch.setattr(DashScopeChatModel, "__call__", _fake_call)
+    return stub
+
+
+@pytest.mark.parametrize("text, symbol", [
+    ("Tell me about NVDA stock", "NVDA"),
+    ("What's NVIDIA's price?", "NVDA"),
+    ("how is apple doing", "AAPL"),
+    ("MSFT vs the market", "MSFT"),
+    ("Microsoft earnings", "MSFT"),
+])
+def test_find_quote_matches_tickers_and_names(text, symbol):
+    assert _find_quote(text).symbol == symbol
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "nvdax",
+    "pineapple",
+    "mſft price",  # Unicode long s folds to "s" only under Unicode matching
+    "nvıdia",  # Dotless i
+])
+def test_find_quote_ignores_non_matches(text):
+    assert _find_quote(text) is None
+
+
+def test_sse_frames_each_line():
+    assert _sse("one") == "data: one\n\n"
+    assert _sse("one\ntwo") == "data: one\ndata: two\n\n"
+
+
+@pytest.mark.parametrize("body", ["{bad", "[1, 2]", '{"input": 1}'])
+def test_chat_rejects_unparseable_bodies(client, body):
+    response = client.post("/chat", content=body, headers={"Content-Type": "application/json"})
+    assert response.status_code == 422
+    assert response.json()["detail"].startswith("Request parsing error")
+
+
+def test_stream_chat_sends_sse_frames(client):
+    response = client.post("/stream_chat", json=_body("Tell me about NVDA stock"))
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    frames = response.text.split("\n\n")
+    assert frames[0] == "data: Processing query: Tell me about NVDA stock"
+    assert frames[1].startswith("data: Stock: NVIDIA Corporation (NVDA)\ndata: Current Price: $180.05")
+
+
+def test_chat_runs_prompt_through_agent_once(client, model):
+    for _ in range(2):
+        response = client.post("/chat", json=_body("What is NVIDIA current stock price?"))
+        assert response.status_code == 200
+        assert response.json() == {"status": "success", "response": "NVDA is at $180.05", "session_id": "test"}
+    assert model.calls == 1
+
+
+def test_chat_no_cache_header_forces_agent_call(client, model):
+    for _ in range(2):
+        client.post("/chat", json=_body("price of nvda?"), headers={"X-No-Cache": "1"})
+    assert model.calls == 2
+
+
+def test_chat_shares_in_flight_reply_with_concurrent_duplicates(client, model):
+    with ThreadPoolExecutor(max_workers=5) as pool:
+        responses = list(pool.map(lambda _: client.post("/chat", json=_body("price of nvda?")), range(5)))
+    assert [r.json()["response"] for r in responses] == ["NVDA is at $180.05"] * 5
+    assert model.calls == 1
+
+
+def test_chat_retries_after_failed_reply(client, model):
+    model.fail = True
+    with pytest.raises(RuntimeError, match="model unavailable"):
+        client.post("/chat", json=_body("price of nvda?"))
+    assert not stock_agent_app._reply_cache
+    model.fail = False
+    assert client.post("/chat", json=_body("price of nvda?")).json()["response"] == "NVDA is at $180.05"
+
+
+def test_ready_after_warm_up_crash(monkeypatch, capsys):
+    def _broken_model():
+        raise ValueError("bad model config")
+
+    monkeypatch.setattr(stock_agent_app, "_agent_ready", False)
+    monkeypatch.setattr(stock_agent_app, "_get_model", _broken_model)
+    with TestClient(stock_agent_app.create_asgi_app()) as c:
+        deadline = time.monotonic() + 5
+        while c.get("/ready").status_code != 200:
+            assert time.monotonic() < deadline, "/ready never turned ok"
+            time.sleep(0.01)
+    assert "Agent warm-up crashed: ValueError('bad model config')" in capsys.readouterr().out